@@ -1,19 +1,35 @@
 import os
+import base64
 import json
 import logging
+import gzip
+import hashlib
 import re
+import threading
 import time
-from typing import Any, Dict, List, Tuple
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 from urllib.parse import urlparse, urljoin
 
 from flask import Flask, jsonify, request, Response
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from dotenv import load_dotenv
 from openai import OpenAI, OpenAIError
 import tldextract
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 
+from profiling import register_profiling
+from shared_state import RateLimiter, SharedCache, SharedCounters, store as shared_store
+
+try:
+    import brotli  # optional: enables Content-Encoding: br
+except ImportError:
+    brotli = None
+
 
 load_dotenv()
 
@@ -23,20 +39,154 @@ logger = logging.getLogger("env-friendly-search")
 app = Flask(__name__)
 # Enable CORS for all routes. The previous pattern r"/**" did not match in Flask-CORS.
 CORS(app)
+# Number of reverse proxies in front of the app whose X-Forwarded-For can be
+# trusted; 0 (default) means the header is ignored and the socket peer is used.
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT", "0"))
+if TRUSTED_PROXY_COUNT > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)  # type: ignore[method-assign]
+# Opt-in per-request CPU/allocation profiling; see profiling.py.
+register_profiling(app)
 
 
 @app.after_request
 def add_cors_headers(response):
     response.headers["Access-Control-Allow-Origin"] = "*"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
+    response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization, If-None-Match, X-Profile"
     response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+    response.headers["Access-Control-Expose-Headers"] = "ETag"
     return response
 
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-5")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 
+# Request JSON-schema constrained output; set to 0 for models without structured output support.
+OPENAI_STRUCTURED_OUTPUT = os.getenv("OPENAI_STRUCTURED_OUTPUT", "1") != "0"
+
 client = OpenAI(timeout=30.0)
 
+# Pooled HTTP session for page, price and image fetches.
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+
+
+def build_http_session() -> requests.Session:
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+    session.mount("https://", HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+    return session
+
+
+http_session = build_http_session()
+
+# Judge results and rate limit counters live in the shared SQLite state so all workers see them.
+JUDGE_CACHE_TTL = float(os.getenv("JUDGE_CACHE_TTL", "3600"))
+RATE_LIMIT_PER_MINUTE = int(os.getenv("RATE_LIMIT_PER_MINUTE", "0"))
+judge_cache = SharedCache(shared_store, "judge", JUDGE_CACHE_TTL, max_entries=int(os.getenv("JUDGE_CACHE_MAX_ENTRIES", "20000")))
+rate_limiter = RateLimiter(shared_store, RATE_LIMIT_PER_MINUTE, 60)
+
+
+def warm_up() -> None:
+    # Called once before workers fork (gunicorn preload) so each worker starts
+    # with the public suffix list loaded and the shared state schema in place.
+    started = time.time()
+    compute_top_level_domain("https://www.amazon.com/")
+    BeautifulSoup("<html></html>", "html.parser")
+    shared_store.purge_expired()
+    logger.info("Warm-up finished in %.2fs", time.time() - started)
+
+
+def reset_after_fork() -> None:
+    # Pooled sockets opened in the parent must not be shared with workers, so each
+    # worker gets its own clients. The inherited ones are dropped, not closed,
+    # since closing would also shut the parent's shared transport state.
+    global client, http_session
+    client = OpenAI(timeout=30.0)
+    http_session = build_http_session()
+
+
+def judge_cache_key(model: str, product_name: str, product_link: str) -> str:
+    raw = "\x1f".join((PROMPT_VERSION, model, product_name, product_link))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def client_rate_key(endpoint: str) -> str:
+    # remote_addr only reflects X-Forwarded-For when TRUSTED_PROXY_COUNT enables ProxyFix.
+    return f"{endpoint}:{request.remote_addr or 'unknown'}"
+
+
+# Conditional responses and compression for JSON endpoints. Cache-Control is per
+# endpoint; anything not listed must revalidate with the ETag before reuse.
+JSON_CACHE_CONTROL: Dict[str, str] = {
+    "/judge": os.getenv("JUDGE_CACHE_CONTROL", "private, max-age=3600"),
+}
+DEFAULT_JSON_CACHE_CONTROL = os.getenv("JSON_CACHE_CONTROL", "private, no-cache")
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+
+
+def negotiate_encoding() -> str:
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return request.accept_encodings.best_match(offered) or ""
+
+
+def iter_gzip(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@app.after_request
+def add_json_cache_headers(response):
+    if response.status_code != 200 or response.mimetype != "application/json" or response.direct_passthrough:
+        return response
+    response.headers.setdefault("Cache-Control", JSON_CACHE_CONTROL.get(request.path, DEFAULT_JSON_CACHE_CONTROL))
+    response.vary.add("Accept-Encoding")
+    if response.is_streamed:
+        # Streamed bodies (inlined images) carry an ETag from stream_json_response
+        # only when every image is already cached, so a 304 never even opens the
+        # upstream images; otherwise they are sent no-store without one.
+        body = None
+        etag = response.get_etag()[0]
+    else:
+        body = response.get_data()
+        # jsonify sorts keys, so identical results always hash to the same ETag.
+        # It is weak because the same payload may be sent gzip/br/identity encoded.
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        response.set_etag(etag, weak=True)
+    if etag and request.if_none_match.contains_weak(etag):
+        response.status_code = 304
+        response.set_data(b"")
+        return response
+    if "Content-Encoding" in response.headers:
+        return response
+    if body is None:
+        if request.accept_encodings.best_match(["gzip"]) == "gzip":
+            response.response = iter_gzip(response.iter_encoded())
+            response.headers.pop("Content-Length", None)
+            response.headers["Content-Encoding"] = "gzip"
+        return response
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    encoding = negotiate_encoding()
+    if encoding == "br":
+        response.set_data(brotli.compress(body, quality=BROTLI_QUALITY))
+    elif encoding == "gzip":
+        response.set_data(gzip.compress(body, compresslevel=GZIP_LEVEL))
+    else:
+        return response
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def rate_limited_response() -> Tuple[Response, int]:
+    return jsonify({
+        "error": "rate_limited",
+        "message": f"Limit of {RATE_LIMIT_PER_MINUTE} requests per minute exceeded."
+    }), 429
+
 
 def compute_top_level_domain(url: str) -> str:
     try:
@@ -68,183 +218,511 @@ def normalize_name_from_url(url: str) -> str:
         return url
 
 
-def extract_items_from_text(text: str) -> List[Dict[str, str]]:
-    logger.debug("Attempting to parse model output as JSON.")
-    try:
-        data = json.loads(text)
-        if isinstance(data, dict) and "results" in data and isinstance(data["results"], list):
-            items = []
-            for item in data["results"]:
-                name = str(item.get("name", "")).strip()
-                url = str(item.get("url", "")).strip()
-                price_val = item.get("price")
-                price = str(price_val).strip() if price_val is not None else ""
-                if not url:
-                    continue
-                if not name:
-                    name = normalize_name_from_url(url)
-                entry = {"name": name, "url": url}
-                if price:
-                    entry["price"] = price
-                items.append(entry)
-            if items:
-                return items
-        if isinstance(data, list):
-            items = []
-            for item in data:
-                if isinstance(item, dict):
-                    name = str(item.get("name", "")).strip()
-                    url = str(item.get("url", "")).strip()
-                    price_val = item.get("price")
-                    price = str(price_val).strip() if price_val is not None else ""
-                    if not url:
-                        continue
-                    if not name:
-                        name = normalize_name_from_url(url)
-                    entry = {"name": name, "url": url}
-                    if price:
-                        entry["price"] = price
-                    items.append(entry)
-            if items:
-                return items
-    except Exception as e:
-        logger.debug("JSON parsing failed, will fall back to regex. Error: %s", e)
+_URL_PATTERN = re.compile(r"https?://[^\s\)\]]+")
+_ASIN_PATTERN = re.compile(r"/(?:dp|gp/product|gp/aw/d|exec/obidos/asin)/([A-Z0-9]{10})(?=[/?#]|$)", re.IGNORECASE)
+_TITLE_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+_PRICE_PATTERN = re.compile(r"[$€£]\s?\d+[\.,]?\d*(?:\.\d{2})?")
+_ECOSCORE_PATTERN = re.compile(r"ecoscore\D*([1-5](?:\.\d+)?)")
+_SCORE_PATTERN = re.compile(r"\b([1-5](?:\.\d+)?)\b")
+
+# JSON schemas sent as the Responses API text format so the model returns
+# output that parses in one json.loads; the regex patterns above are only a
+# last resort for models or calls that ignore the schema.
+RESULTS_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "url": {"type": "string"},
+                    "price": {"type": "string"},
+                },
+                "required": ["name", "url", "price"],
+                "additionalProperties": False,
+            },
+        }
+    },
+    "required": ["results"],
+    "additionalProperties": False,
+}
+
+JUDGE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {"ecoscore": {"type": "number"}},
+    "required": ["ecoscore"],
+    "additionalProperties": False,
+}
+
+
+def structured_output_kwargs(name: str, schema: Dict[str, Any]) -> Dict[str, Any]:
+    if not OPENAI_STRUCTURED_OUTPUT:
+        return {}
+    return {"text": {"format": {"type": "json_schema", "name": name, "schema": schema, "strict": True}}}
+
+
+class SearchItem:
+    __slots__ = ("name", "url", "price", "tld", "image", "image_data_url", "name_from_url")
+
+    def __init__(self, name: str, url: str, price: str = "", name_from_url: bool = False) -> None:
+        self.name = name
+        self.url = url
+        self.price = price
+        # True when the model gave no name and it was made up from the URL host
+        self.name_from_url = name_from_url
+        self.tld = ""
+        self.image = ""
+        self.image_data_url: Any = ""  # str or InlineImage streamed at response time
+
+    def to_dict(self) -> Dict[str, Any]:
+        entry = {"name": self.name, "url": self.url}
+        for key in ("price", "tld", "image", "image_data_url"):
+            val = getattr(self, key)
+            if val or key == "tld":
+                entry[key] = val
+        return entry
+
+
+class JudgeResult:
+    __slots__ = ("impact", "ecoscore")
+
+    def __init__(self, impact: str, ecoscore: float) -> None:
+        self.impact = impact
+        self.ecoscore = ecoscore
+
+
+def coerce_search_item(raw: Any) -> Optional[SearchItem]:
+    if not isinstance(raw, dict):
+        return None
+    url = str(raw.get("url", "")).strip()
+    if not url:
+        return None
+    name = str(raw.get("name", "")).strip()
+    price_val = raw.get("price")
+    price = str(price_val).strip() if price_val is not None else ""
+    if not name:
+        return SearchItem(normalize_name_from_url(url), url, price, name_from_url=True)
+    return SearchItem(name, url, price)
+
+
+def extract_items_from_text(text: str) -> List[SearchItem]:
+    text = text or ""
+    stripped = text.lstrip()
+    if stripped[:1] in ("{", "["):
+        try:
+            data = json.loads(stripped)
+        except ValueError as e:
+            logger.debug("JSON parsing failed, will fall back to regex. Error: %s", e)
+        else:
+            raw_items = data.get("results") if isinstance(data, dict) else data
+            if isinstance(raw_items, list):
+                items = [it for it in map(coerce_search_item, raw_items) if it is not None]
+                if items:
+                    return items
 
     logger.debug("Falling back to regex URL extraction.")
-    url_pattern = re.compile(r"https?://[^\s\)\]]+")
-    urls = url_pattern.findall(text or "")
-    dedup_urls = []
-    seen = set()
-    for u in urls:
-        if u not in seen:
-            seen.add(u)
-            dedup_urls.append(u)
-    items = [{"name": normalize_name_from_url(u), "url": u} for u in dedup_urls]
-    return items
+    # dict.fromkeys de-duplicates while keeping first-seen order
+    urls = dict.fromkeys(_URL_PATTERN.findall(text))
+    return [SearchItem(normalize_name_from_url(u), u, name_from_url=True) for u in urls]
 
 
-def fetch_og_image(target_url: str) -> str:
+# Near-duplicate collapsing: listings sharing an ASIN, or whose normalized titles
+# overlap by at least this Jaccard similarity of token shingles, are one product.
+DEDUP_TITLE_SIMILARITY = float(os.getenv("DEDUP_TITLE_SIMILARITY", "0.6"))
+# Extra candidates to ask the model for, so collapsed duplicates can be replaced.
+SEARCH_CANDIDATE_EXTRA = int(os.getenv("SEARCH_CANDIDATE_EXTRA", "2"))
+
+
+def extract_asin(url: str) -> str:
+    # /dp/<id> paths on other stores are not ASINs, so only Amazon links count.
+    if not is_amazon_url(url):
+        return ""
+    m = _ASIN_PATTERN.search(urlparse(url).path or "")
+    return m.group(1).upper() if m else ""
+
+
+def title_shingles(name: str) -> frozenset:
+    tokens = _TITLE_TOKEN_PATTERN.findall(name.lower())
+    if len(tokens) < 2:
+        return frozenset(tokens)
+    return frozenset(zip(tokens, tokens[1:]))
+
+
+def shingle_similarity(a: frozenset, b: frozenset) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def collapse_duplicates(items: List[SearchItem], preferred_suffix: str = "") -> List[SearchItem]:
+    groups: List[List[SearchItem]] = []
+    group_asins: List[set] = []
+    group_shingles: List[List[frozenset]] = []
+    for item in items:
+        asin = extract_asin(item.url)
+        # Placeholder names like "Amazon" say nothing about the product, so only
+        # titles the model actually returned take part in similarity matching.
+        shingles = frozenset() if item.name_from_url else title_shingles(item.name)
+        for idx in range(len(groups)):
+            if (asin and asin in group_asins[idx]) or any(
+                shingle_similarity(shingles, other) >= DEDUP_TITLE_SIMILARITY for other in group_shingles[idx]
+            ):
+                groups[idx].append(item)
+                if asin:
+                    group_asins[idx].add(asin)
+                group_shingles[idx].append(shingles)
+                break
+        else:
+            groups.append([item])
+            group_asins.append({asin} if asin else set())
+            group_shingles.append([shingles])
+
+    def rank(item: SearchItem) -> Tuple[int, int]:
+        # Caller's marketplace first, then listings that already carry a price.
+        same_market = bool(preferred_suffix) and compute_top_level_domain(item.url) == preferred_suffix
+        return (0 if same_market else 1, 0 if item.price else 1)
+
+    # min() keeps the model's original order among equally ranked listings.
+    collapsed = [min(group, key=rank) for group in groups]
+    if len(collapsed) < len(items):
+        logger.debug("Collapsed %d results into %d distinct products", len(items), len(collapsed))
+    return collapsed
+
+
+def image_from_soup(soup: BeautifulSoup, target_url: str) -> str:
+    # Try Open Graph first
+    og = soup.find("meta", attrs={"property": "og:image"})
+    if og and og.get("content"):
+        return urljoin(target_url, og.get("content"))
+    og2 = soup.find("meta", attrs={"property": "og:image:secure_url"})
+    if og2 and og2.get("content"):
+        return urljoin(target_url, og2.get("content"))
+    tw = soup.find("meta", attrs={"name": "twitter:image"})
+    if tw and tw.get("content"):
+        return urljoin(target_url, tw.get("content"))
+    # Amazon-specific extraction (first product image)
+    if is_amazon_url(target_url):
+        # Common product image element
+        landing = soup.select_one("img#landingImage")
+        if landing:
+            # Prefer high-res hint
+            hires = landing.get("data-old-hires")
+            if hires:
+                return urljoin(target_url, hires)
+            dyn = landing.get("data-a-dynamic-image")
+            if dyn:
+                try:
+                    data = json.loads(dyn)
+                    if isinstance(data, dict) and data:
+                        # Pick the first URL key
+                        first_key = next(iter(data.keys()))
+                        if first_key:
+                            return urljoin(target_url, first_key)
+                except Exception:
+                    # Attempt to normalize quotes and extract first URL
+                    try:
+                        norm = dyn.replace("&quot;", '"')
+                        data = json.loads(norm)
+                        if isinstance(data, dict) and data:
+                            first_key = next(iter(data.keys()))
+                            if first_key:
+                                return urljoin(target_url, first_key)
+                    except Exception:
+                        m = re.search(r"https?://[^\"]+", dyn)
+                        if m:
+                            return urljoin(target_url, m.group(0))
+            srcset = landing.get("srcset")
+            if srcset:
+                # Choose the last (highest density) URL
+                parts = [p.strip() for p in srcset.split(',') if p.strip()]
+                if parts:
+                    last = parts[-1].split(' ')[0]
+                    if last:
+                        return urljoin(target_url, last)
+            src = landing.get("src")
+            if src:
+                return urljoin(target_url, src)
+        # Alternate wrappers
+        wrap_img = soup.select_one("#imgTagWrapperId img")
+        if wrap_img:
+            # Try srcset first
+            w_srcset = wrap_img.get("srcset")
+            if w_srcset:
+                parts = [p.strip() for p in w_srcset.split(',') if p.strip()]
+                if parts:
+                    last = parts[-1].split(' ')[0]
+                    if last:
+                        return urljoin(target_url, last)
+            if wrap_img.get("src"):
+                return urljoin(target_url, wrap_img.get("src"))
+        book_img = soup.select_one("img#imgBlkFront")
+        if book_img and book_img.get("src"):
+            return urljoin(target_url, book_img.get("src"))
+    # Fallback to first image on page
+    img = soup.find("img")
+    if img and img.get("src"):
+        return urljoin(target_url, img.get("src"))
+    return ""
+
+
+def amazon_price_from_soup(soup: BeautifulSoup, html: str) -> str:
+    # Try known price selectors
+    sel_candidates = [
+        "#corePrice_feature_div span.a-offscreen",
+        "#apex_desktop span.a-offscreen",
+        "#priceblock_ourprice",
+        "#priceblock_dealprice",
+        "#priceblock_saleprice",
+    ]
+    for sel in sel_candidates:
+        el = soup.select_one(sel)
+        if el and el.get_text(strip=True):
+            return el.get_text(strip=True)
+    # Fallback regex like $12.99
+    m = _PRICE_PATTERN.search(html)
+    if m:
+        return m.group(0)
+    return ""
+
+
+# Page, price and inlined image lookups are cached in the shared state so
+# /prefetch work and concurrent workers reuse each other's fetches.
+# Keys are arbitrary URLs (reachable through /prefetch), so both namespaces are
+# size-capped and trimmed periodically rather than only at startup.
+PAGE_CACHE_TTL = float(os.getenv("PAGE_CACHE_TTL", "21600"))
+PAGE_CACHE_MAX_ENTRIES = int(os.getenv("PAGE_CACHE_MAX_ENTRIES", "5000"))
+IMAGE_CACHE_TTL = float(os.getenv("IMAGE_CACHE_TTL", "21600"))
+IMAGE_CACHE_MAX_ENTRIES = int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", "200"))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+page_cache = SharedCache(shared_store, "page", PAGE_CACHE_TTL, max_entries=PAGE_CACHE_MAX_ENTRIES)
+image_cache = SharedCache(
+    shared_store, "image", IMAGE_CACHE_TTL,
+    max_entries=IMAGE_CACHE_MAX_ENTRIES, max_bytes=IMAGE_CACHE_MAX_BYTES, trim_every=10,
+)
+
+
+def page_details(target_url: str) -> Dict[str, str]:
+    cached = page_cache.get(target_url)
+    if cached is not None:
+        return cached
+    details = {"image": "", "price": ""}
     try:
         headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
             "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8",
             "Accept-Language": "en-US,en;q=0.9"
         }
-        resp = requests.get(target_url, headers=headers, timeout=6)
+        resp = http_session.get(target_url, headers=headers, timeout=6)
         if not resp.ok:
-            return ""
+            return details
         html = resp.text or ""
         soup = BeautifulSoup(html, "html.parser")
-        # Try Open Graph first
-        og = soup.find("meta", attrs={"property": "og:image"})
-        if og and og.get("content"):
-            return urljoin(target_url, og.get("content"))
-        og2 = soup.find("meta", attrs={"property": "og:image:secure_url"})
-        if og2 and og2.get("content"):
-            return urljoin(target_url, og2.get("content"))
-        tw = soup.find("meta", attrs={"name": "twitter:image"})
-        if tw and tw.get("content"):
-            return urljoin(target_url, tw.get("content"))
-        # Amazon-specific extraction (first product image)
+        details["image"] = image_from_soup(soup, target_url)
         if is_amazon_url(target_url):
-            # Common product image element
-            landing = soup.select_one("img#landingImage")
-            if landing:
-                # Prefer high-res hint
-                hires = landing.get("data-old-hires")
-                if hires:
-                    return urljoin(target_url, hires)
-                dyn = landing.get("data-a-dynamic-image")
-                if dyn:
-                    try:
-                        data = json.loads(dyn)
-                        if isinstance(data, dict) and data:
-                            # Pick the first URL key
-                            first_key = next(iter(data.keys()))
-                            if first_key:
-                                return urljoin(target_url, first_key)
-                    except Exception:
-                        # Attempt to normalize quotes and extract first URL
-                        try:
-                            norm = dyn.replace("&quot;", '"')
-                            data = json.loads(norm)
-                            if isinstance(data, dict) and data:
-                                first_key = next(iter(data.keys()))
-                                if first_key:
-                                    return urljoin(target_url, first_key)
-                        except Exception:
-                            m = re.search(r"https?://[^\"]+", dyn)
-                            if m:
-                                return urljoin(target_url, m.group(0))
-                srcset = landing.get("srcset")
-                if srcset:
-                    # Choose the last (highest density) URL
-                    parts = [p.strip() for p in srcset.split(',') if p.strip()]
-                    if parts:
-                        last = parts[-1].split(' ')[0]
-                        if last:
-                            return urljoin(target_url, last)
-                src = landing.get("src")
-                if src:
-                    return urljoin(target_url, src)
-            # Alternate wrappers
-            wrap_img = soup.select_one("#imgTagWrapperId img")
-            if wrap_img:
-                # Try srcset first
-                w_srcset = wrap_img.get("srcset")
-                if w_srcset:
-                    parts = [p.strip() for p in w_srcset.split(',') if p.strip()]
-                    if parts:
-                        last = parts[-1].split(' ')[0]
-                        if last:
-                            return urljoin(target_url, last)
-                if wrap_img.get("src"):
-                    return urljoin(target_url, wrap_img.get("src"))
-            book_img = soup.select_one("img#imgBlkFront")
-            if book_img and book_img.get("src"):
-                return urljoin(target_url, book_img.get("src"))
-        # Fallback to first image on page
-        img = soup.find("img")
-        if img and img.get("src"):
-            return urljoin(target_url, img.get("src"))
-        return ""
+            details["price"] = amazon_price_from_soup(soup, html)
     except Exception as e:
-        logger.debug("OG image fetch failed for %s: %s", target_url, e)
-        return ""
+        logger.debug("Page fetch failed for %s: %s", target_url, e)
+        return details
+    page_cache.set(target_url, details)
+    return details
+
+
+def fetch_og_image(target_url: str) -> str:
+    return page_details(target_url)["image"]
 
 
 def extract_amazon_price(target_url: str) -> str:
-    try:
-        if not is_amazon_url(target_url):
-            return ""
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
-            "Accept-Language": "en-US,en;q=0.9",
-        }
-        resp = requests.get(target_url, headers=headers, timeout=6)
-        if not resp.ok:
-            return ""
-        soup = BeautifulSoup(resp.text or "", "html.parser")
-        # Try known price selectors
-        sel_candidates = [
-            "#corePrice_feature_div span.a-offscreen",
-            "#apex_desktop span.a-offscreen",
-            "#priceblock_ourprice",
-            "#priceblock_dealprice",
-            "#priceblock_saleprice",
-        ]
-        for sel in sel_candidates:
-            el = soup.select_one(sel)
-            if el and el.get_text(strip=True):
-                return el.get_text(strip=True)
-        # Fallback regex like $12.99
-        m = re.search(r"[$€£]\s?\d+[\.,]?\d*(?:\.\d{2})?", resp.text or "")
-        if m:
-            return m.group(0)
+    if not is_amazon_url(target_url):
         return ""
+    return page_details(target_url)["price"]
+
+
+# Inlined images are streamed from upstream through an incremental base64
+# encoder straight into the response, so a request never holds more than one
+# chunk (or, without Content-Length, one capped buffer) per image.
+IMAGE_INLINE_MAX_BYTES = int(os.getenv("IMAGE_INLINE_MAX_BYTES", str(2 * 1024 * 1024)))
+IMAGE_STREAM_CHUNK = 48 * 1024  # multiple of 3, so chunks encode without padding
+
+
+class InlineImage:
+    __slots__ = ("url", "referer")
+
+    def __init__(self, url: str, referer: str = "") -> None:
+        self.url = url
+        self.referer = referer
+
+
+def iter_base64(chunks: Iterable[bytes]) -> Iterator[str]:
+    carry = b""
+    for chunk in chunks:
+        if carry:
+            chunk = carry + bytes(chunk)
+        cut = len(chunk) - len(chunk) % 3
+        if cut:
+            yield base64.b64encode(chunk[:cut]).decode("ascii")
+        carry = chunk[cut:]
+    if carry:
+        yield base64.b64encode(carry).decode("ascii")
+
+
+def open_image_stream(img_url: str, referer: str = "", collect: bool = False) -> Optional[Iterator[str]]:
+    # Returns the data URL as an iterator of str pieces, or None when the image
+    # is unavailable or larger than IMAGE_INLINE_MAX_BYTES. Once streaming has
+    # started, an upstream error or short body raises from the iterator so the
+    # response is aborted instead of ending in a truncated image. Only collect=True
+    # (background warm-up) keeps the encoded image to store in image_cache;
+    # response streams never hold more than one chunk.
+    if not img_url:
+        return None
+    cached = image_cache.get(img_url)
+    if cached is not None:
+        return iter((cached,))
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+    }
+    if referer:
+        headers["Referer"] = referer
+    try:
+        r = http_session.get(img_url, headers=headers, timeout=8, stream=True)
     except Exception as e:
-        logger.debug("Price extract failed for %s: %s", target_url, e)
-        return ""
+        logger.debug("Data URL build failed for %s: %s", img_url, e)
+        return None
+    if not r.ok:
+        r.close()
+        return None
+    declared = r.headers.get("Content-Length", "")
+    expected = 0
+    if declared.isdigit():
+        if int(declared) == 0 or int(declared) > IMAGE_INLINE_MAX_BYTES:
+            logger.debug("Skipping inline image %s (%s bytes)", img_url, declared)
+            r.close()
+            return None
+        body: Iterable[bytes] = r.iter_content(IMAGE_STREAM_CHUNK)
+        if r.headers.get("Content-Encoding", "identity").lower() == "identity":
+            expected = int(declared)
+    else:
+        # Unknown length: read at most the cap before committing to inline it.
+        try:
+            buf = r.raw.read(IMAGE_INLINE_MAX_BYTES + 1, decode_content=True)
+        except Exception as e:
+            logger.debug("Data URL build failed for %s: %s", img_url, e)
+            r.close()
+            return None
+        if not buf or len(buf) > IMAGE_INLINE_MAX_BYTES:
+            r.close()
+            return None
+        view = memoryview(buf)
+        body = (view[i:i + IMAGE_STREAM_CHUNK] for i in range(0, len(buf), IMAGE_STREAM_CHUNK))
+    ctype = r.headers.get("Content-Type", "image/jpeg")
+    return _iter_data_url(img_url, ctype, body, r, collect, expected)
+
+
+def _count_bytes(body: Iterable[bytes], counter: List[int]) -> Iterator[bytes]:
+    for chunk in body:
+        counter[0] += len(chunk)
+        yield chunk
+
+
+def _iter_data_url(
+    img_url: str, ctype: str, body: Iterable[bytes], upstream: requests.Response, collect: bool, expected: int = 0
+) -> Iterator[str]:
+    pieces: Optional[List[str]] = [] if collect and image_cache.ttl_seconds > 0 else None
+    received = [0]
+    try:
+        prefix = f"data:{ctype};base64,"
+        if pieces is not None:
+            pieces.append(prefix)
+        yield prefix
+        for piece in iter_base64(_count_bytes(body, received)):
+            if pieces is not None:
+                pieces.append(piece)
+            yield piece
+        if expected and received[0] != expected:
+            raise IOError(f"got {received[0]} of {expected} bytes")
+    except Exception as e:
+        logger.warning("Image stream interrupted for %s: %s", img_url, e)
+        raise
+    finally:
+        upstream.close()
+    if pieces is not None:
+        image_cache.set(img_url, "".join(pieces))
+
+
+def warm_image_cache(img_url: str, referer: str = "") -> None:
+    stream = open_image_stream(img_url, referer, collect=True)
+    if stream is None:
+        return
+    try:
+        for _ in stream:
+            pass
+    except Exception:
+        # Already logged; nothing is cached for an incomplete image.
+        pass
+
+
+def iter_json(value: Any) -> Iterator[str]:
+    # Same output as jsonify (sorted keys, compact separators), except that an
+    # InlineImage is streamed as its data URL and dropped from dicts if unavailable.
+    if isinstance(value, dict):
+        yield "{"
+        first = True
+        for key in sorted(value):
+            item = value[key]
+            if isinstance(item, InlineImage):
+                stream = open_image_stream(item.url, item.referer)
+                if stream is None:
+                    continue
+                yield ("" if first else ",") + json.dumps(key) + ':"'
+                yield from stream
+                yield '"'
+            else:
+                yield ("" if first else ",") + json.dumps(key) + ":"
+                yield from iter_json(item)
+            first = False
+        yield "}"
+    elif isinstance(value, list):
+        yield "["
+        for idx, item in enumerate(value):
+            if idx:
+                yield ","
+            yield from iter_json(item)
+        yield "]"
+    elif isinstance(value, InlineImage):
+        stream = open_image_stream(value.url, value.referer)
+        if stream is None:
+            yield "null"
+        else:
+            yield '"'
+            yield from stream
+            yield '"'
+    else:
+        yield json.dumps(value, separators=(",", ":"))
+
+
+def inline_images(value: Any) -> Iterator[InlineImage]:
+    if isinstance(value, InlineImage):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from inline_images(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from inline_images(item)
+
+
+def stream_json_response(result: Dict[str, Any]) -> Response:
+    response = Response(iter_json(result), mimetype="application/json")
+    # An image fetched upstream may still be dropped or cut short, and a 304
+    # would pin that broken body, so only fully cached payloads get an ETag.
+    # It covers the payload with each inlined image identified by its URL.
+    if all(image_cache.contains(img.url) for img in inline_images(result)):
+        skeleton = json.dumps(result, sort_keys=True, default=lambda o: o.url if isinstance(o, InlineImage) else str(o))
+        response.set_etag(hashlib.blake2b(skeleton.encode("utf-8"), digest_size=16).hexdigest(), weak=True)
+    else:
+        response.headers["Cache-Control"] = "no-store"
+    return response
 
 
 @app.route("/image-proxy", methods=["GET"])
@@ -258,7 +736,7 @@ def image_proxy() -> Tuple[bytes, int]:
         headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
         }
-        r = requests.get(target_url, headers=headers, timeout=8)
+        r = http_session.get(target_url, headers=headers, timeout=8)
         if not r.ok:
             return jsonify({"error": "upstream_error", "status": r.status_code}), 502
         content_type = r.headers.get("Content-Type", "image/jpeg")
@@ -281,69 +759,93 @@ def extract_image() -> Tuple[str, int]:
     img_url = fetch_og_image(target_url)
     result: Dict[str, Any] = {"image": img_url}
     if img_url:
-        try:
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
-                "Referer": target_url,
-            }
-            r = requests.get(img_url, headers=headers, timeout=8)
-            if r.ok and r.content:
-                ctype = r.headers.get("Content-Type", "image/jpeg")
-                import base64
-                b64 = base64.b64encode(r.content).decode("ascii")
-                result["image_data_url"] = f"data:{ctype};base64,{b64}"
-        except Exception as e:
-            logger.debug("extract-image data url build failed for %s: %s", img_url, e)
-    return jsonify(result), 200
+        result["image_data_url"] = InlineImage(img_url, referer=target_url)
+    return stream_json_response(result), 200
+
+
+# Prompts are laid out as a fixed, versioned instruction prefix followed by the
+# per-request lines so the provider can reuse its cached prompt prefix.
+# Bump PROMPT_VERSION whenever any of the static blocks below change.
+PROMPT_VERSION = "3"
+
+RESULTS_JSON_INSTRUCTION = (
+    "Include an approximate price with currency where available.\n"
+    "Produce ONLY JSON with this shape exactly:\n"
+    '{ "results": [ { "name": "Product or Brand Name", "url": "https://...", "price": "$12.99" } ] }\n'
+    "Do not include explanations or markdown, only valid JSON."
+)
+
+SEARCH_INSTRUCTIONS = (
+    f"[ecocart-search v{PROMPT_VERSION}]\n"
+    "Use web_search to find environmentally friendlier product options for the user's topic.\n"
+    "Focus on credible official product or brand pages, sustainability certifications, and lifecycle considerations.\n"
+    "Return at most the number of distinct results requested below.\n"
+    f"{RESULTS_JSON_INSTRUCTION}"
+)
+
+ALTERNATIVES_INSTRUCTIONS = (
+    f"[ecocart-alternatives v{PROMPT_VERSION}]\n"
+    "Using web_search, find environmentally friendlier alternatives to the given product.\n"
+    "Prioritize durable, reusable, recyclable, compostable, or certified-sustainable materials (e.g., paper, metal, bamboo, glass, silicone when appropriate).\n"
+    "Only search and return results from Amazon retail domains: amazon.com, amazon.ca, amazon.co.uk, amazon.de, amazon.fr, amazon.it, amazon.es, amazon.co.jp, amazon.in, amazon.com.au.\n"
+    "Use site:amazon.* operators in your web_search queries to constrain results.\n"
+    "Return at most the number of distinct alternatives requested below.\n"
+    f"{RESULTS_JSON_INSTRUCTION}"
+)
+
+JUDGE_INSTRUCTIONS = (
+    f"[ecocart-judge v{PROMPT_VERSION}]\n"
+    "Rate the product's environmental friendliness with a single Ecoscore between 1.0 and 5.0 (decimals allowed).\n"
+    "Use this rubric strictly:\n"
+    "1.0–1.9: predominantly single-use plastic; non-recyclable; no credible sustainability claims.\n"
+    "2.0–2.9: disposable plastic-heavy; limited recyclability or greenwashing; short lifespan.\n"
+    "3.0–3.9: mixed/unknown materials; partial recyclability; some reuse potential; average footprint.\n"
+    "4.0–4.4: largely sustainable materials (paper, glass, silicone), reusable or recyclable; credible claims.\n"
+    "4.5–5.0: highly sustainable (durable metal/bamboo/glass, certified compostable), long lifespan, minimal waste.\n"
+    "Consider materials, reusability, recyclability/compostability, lifecycle/durability, packaging, and certifications.\n"
+    "If the product appears to be paper drinking straws, ensure Ecoscore ≥ 4.5 barring contradictory evidence.\n"
+    'Respond ONLY with JSON: {"ecoscore": <number>} (e.g., {"ecoscore": 4.5}). No explanations.'
+)
 
 
 def build_prompt(user_query: str, max_results: int) -> str:
-    base_instruction = (
-        "Use web_search to find environmentally friendlier product options for the user's topic.\n"
-        "Focus on credible official product or brand pages, sustainability certifications, and lifecycle considerations.\n"
-        f"Return up to {max_results} distinct results.\n"
-        "Include an approximate price with currency where available.\n"
-        "Produce ONLY JSON with this shape exactly:\n"
-        '{ "results": [ { "name": "Product or Brand Name", "url": "https://...", "price": "$12.99" } ] }\n'
-        "Do not include explanations or markdown, only valid JSON."
-    )
     topic_line = f"User topic: {user_query.strip() or 'environmentally friendlier everyday products'}"
-    return f"{topic_line}\n\n{base_instruction}"
+    return f"{SEARCH_INSTRUCTIONS}\n\nResults requested: {max_results}\n{topic_line}"
 
 
 def build_alternatives_prompt(product_name: str, product_link: str, max_results: int) -> str:
     name_line = f"Original product: {product_name.strip()}" if product_name else "Original product: (unknown name)"
     link_line = f"Original link: {product_link.strip()}" if product_link else "Original link: (none provided)"
-    base_instruction = (
-        "Using web_search, find environmentally friendlier alternatives to the given product.\n"
-        "Prioritize durable, reusable, recyclable, compostable, or certified-sustainable materials (e.g., paper, metal, bamboo, glass, silicone when appropriate).\n"
-        "Only search and return results from Amazon retail domains: amazon.com, amazon.ca, amazon.co.uk, amazon.de, amazon.fr, amazon.it, amazon.es, amazon.co.jp, amazon.in, amazon.com.au.\n"
-        "Use site:amazon.* operators in your web_search queries to constrain results.\n"
-        f"Return up to {max_results} distinct alternatives.\n"
-        "Include an approximate price with currency where available.\n"
-        "Produce ONLY JSON with this shape exactly:\n"
-        '{ "results": [ { "name": "Product or Brand Name", "url": "https://...", "price": "$12.99" } ] }\n'
-        "Do not include explanations or markdown, only valid JSON."
-    )
-    return f"{name_line}\n{link_line}\n\n{base_instruction}"
+    return f"{ALTERNATIVES_INSTRUCTIONS}\n\nAlternatives requested: {max_results}\n{name_line}\n{link_line}"
 
 
 def build_judge_prompt(product_name: str, product_link: str) -> str:
     name_line = f"Product: {product_name.strip()}" if product_name else "Product: (unknown name)"
     link_line = f"Link: {product_link.strip()}" if product_link else "Link: (none provided)"
-    instruction = (
-        "Rate the product's environmental friendliness with a single Ecoscore between 1.0 and 5.0 (decimals allowed).\n"
-        "Use this rubric strictly:\n"
-        "1.0–1.9: predominantly single-use plastic; non-recyclable; no credible sustainability claims.\n"
-        "2.0–2.9: disposable plastic-heavy; limited recyclability or greenwashing; short lifespan.\n"
-        "3.0–3.9: mixed/unknown materials; partial recyclability; some reuse potential; average footprint.\n"
-        "4.0–4.4: largely sustainable materials (paper, glass, silicone), reusable or recyclable; credible claims.\n"
-        "4.5–5.0: highly sustainable (durable metal/bamboo/glass, certified compostable), long lifespan, minimal waste.\n"
-        "Consider materials, reusability, recyclability/compostability, lifecycle/durability, packaging, and certifications.\n"
-        "If the product appears to be paper drinking straws, ensure Ecoscore ≥ 4.5 barring contradictory evidence.\n"
-        "Respond ONLY with: Ecoscore: <number> (e.g., Ecoscore: 4.5). No explanations."
+    return f"{JUDGE_INSTRUCTIONS}\n\n{name_line}\n{link_line}"
+
+
+# Running token totals per endpoint, exposed at /metrics/tokens.
+# Kept in the shared state so every worker reports the same totals.
+token_counters = SharedCounters(shared_store, "tokens")
+
+
+def record_token_usage(endpoint: str, response: Any) -> Dict[str, int]:
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return {}
+    details = getattr(usage, "input_tokens_details", None)
+    counts = {
+        "input_tokens": int(getattr(usage, "input_tokens", 0) or 0),
+        "cached_tokens": int(getattr(details, "cached_tokens", 0) or 0) if details is not None else 0,
+        "output_tokens": int(getattr(usage, "output_tokens", 0) or 0),
+    }
+    logger.info(
+        "Token usage endpoint=%s input=%d cached=%d output=%d",
+        endpoint, counts["input_tokens"], counts["cached_tokens"], counts["output_tokens"],
     )
-    return f"{name_line}\n{link_line}\n\n{instruction}"
+    token_counters.add(endpoint, {"calls": 1, **counts})
+    return counts
 
 
 def infer_material_hint(product_name: str, product_link: str) -> str:
@@ -366,48 +868,48 @@ def infer_material_hint(product_name: str, product_link: str) -> str:
     return ""
 
 
-def parse_impact_label(text: str) -> str:
-    if not text:
-        return "Medium"
-    lowered = text.lower()
-    if "low" in lowered:
-        return "Low"
-    if "high" in lowered:
-        return "High"
-    if "medium" in lowered:
-        return "Medium"
-    # Last token heuristic
-    tokens = [t.strip().lower() for t in re.split(r"[^a-zA-Z]+", lowered) if t.strip()]
-    for t in tokens:
-        if t in ("low", "medium", "high"):
-            return t.capitalize()
+def _impact_from_lowered(lowered: str) -> str:
+    for label in ("low", "high", "medium"):
+        if label in lowered:
+            return label.capitalize()
     return "Medium"
 
 
-def parse_ecoscore_from_text(text: str) -> float:
-    try:
-        # Look for a number between 1 and 5 (optionally with decimals). Prioritize patterns near 'ecoscore'.
-        if not text:
-            return 0.0
-        lowered = text.lower()
-        near_score = re.search(r"ecoscore\D*([1-5](?:\.\d+)?)", lowered)
-        if near_score:
-            val = float(near_score.group(1))
-            if 1.0 <= val <= 5.0:
-                return val
-        # Generic number search
-        for match in re.finditer(r"\b([1-5](?:\.\d+)?)\b", lowered):
-            try:
-                val = float(match.group(1))
-                if 1.0 <= val <= 5.0:
-                    return val
-            except Exception:
-                continue
-    except Exception:
-        pass
+def _ecoscore_from_lowered(lowered: str) -> float:
+    # Look for a number between 1 and 5 (optionally with decimals). Prioritize patterns near 'ecoscore'.
+    near_score = _ECOSCORE_PATTERN.search(lowered)
+    if near_score:
+        val = float(near_score.group(1))
+        if 1.0 <= val <= 5.0:
+            return val
+    # Generic number search
+    for match in _SCORE_PATTERN.finditer(lowered):
+        val = float(match.group(1))
+        if 1.0 <= val <= 5.0:
+            return val
     return 0.0
 
 
+def parse_judge_output(text: str) -> JudgeResult:
+    lowered = (text or "").lower()
+    impact = _impact_from_lowered(lowered)
+    ecoscore = 0.0
+    if lowered.lstrip().startswith("{"):
+        try:
+            data = json.loads(lowered)
+            ecoscore = float(data.get("ecoscore", 0.0)) if isinstance(data, dict) else 0.0
+        except (ValueError, TypeError) as e:
+            logger.debug("Judge JSON parsing failed, will fall back to regex. Error: %s", e)
+        if not 1.0 <= ecoscore <= 5.0:
+            ecoscore = 0.0
+    if ecoscore <= 0.0 and lowered:
+        ecoscore = _ecoscore_from_lowered(lowered)
+    # If the model didn't return a numeric ecoscore, fall back to label mapping only
+    if ecoscore <= 0.0:
+        ecoscore = ecoscore_from_impact(impact)
+    return JudgeResult(impact, ecoscore)
+
+
 def ecoscore_from_impact(impact: str) -> float:
     # Slightly stricter baseline mapping
     mapping = {"Low": 4.2, "Medium": 2.8, "High": 1.3}
@@ -438,13 +940,150 @@ def apply_material_heuristics_to_ecoscore(score: float, material_hint: str) -> f
     return round(adjusted, 2)
 
 
+class JudgeError(Exception):
+    def __init__(self, error: str, message: str, status: int) -> None:
+        super().__init__(message)
+        self.error = error
+        self.message = message
+        self.status = status
+
+
+def judge_product(product_name: str, product_link: str, request_model: str, endpoint: str) -> JudgeResult:
+    cache_key = judge_cache_key(request_model, product_name, product_link)
+    cached = judge_cache.get(cache_key)
+    if cached:
+        logger.info("Judge cache hit endpoint=%s", endpoint)
+        return JudgeResult(cached["impact"], cached["ecoscore"])
+
+    prompt = build_judge_prompt(product_name, product_link)
+
+    def call_openai(selected_model: str):
+        return client.responses.create(
+            model=selected_model,
+            input=prompt,
+            **structured_output_kwargs("ecoscore", JUDGE_SCHEMA),
+        )
+
+    try:
+        response = call_openai(request_model)
+    except OpenAIError as oe:
+        message_text = str(oe)
+        logger.warning("OpenAI judge error with model %s: %s", request_model, message_text)
+        is_rate_limited = ("429" in message_text) or ("rate limit" in message_text.lower())
+        if is_rate_limited and request_model != "gpt-5":
+            logger.info("Judge retry with fallback model gpt-5 after backoff...")
+            time.sleep(1.5)
+            try:
+                response = call_openai("gpt-5")
+            except Exception as e2:
+                logger.exception("Judge fallback failed: %s", e2)
+                raise JudgeError("openai_api_error", str(e2), 502)
+        else:
+            raise JudgeError("openai_api_error", message_text, 502)
+    except Exception as e:
+        logger.exception("Unexpected error calling OpenAI for judge: %s", e)
+        raise JudgeError("server_error", str(e), 500)
+
+    try:
+        raw_dump = response.model_dump_json(indent=2)  # type: ignore[attr-defined]
+        print("=== OpenAI raw judge response (model_dump_json) ===")
+        print(raw_dump)
+    except Exception:
+        print("=== OpenAI judge response (repr) ===")
+        print(repr(response))
+
+    record_token_usage(endpoint, response)
+    output_text = getattr(response, "output_text", None)
+    if output_text is None:
+        try:
+            output_text = response.output[0].content[0].text  # type: ignore[attr-defined]
+        except Exception:
+            output_text = ""
+
+    print("=== OpenAI judge output_text ===")
+    print(output_text)
+
+    judged = parse_judge_output(output_text or "")
+    judge_cache.set(cache_key, {"impact": judged.impact, "ecoscore": judged.ecoscore})
+    return judged
+
+
+# Background warm-up for products the extension expects to be asked about next.
+# Work is bounded by PREFETCH_QUEUE_SIZE (queued + running) and runs on at most
+# PREFETCH_CONCURRENCY threads so it cannot crowd out foreground requests.
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "2"))
+PREFETCH_QUEUE_SIZE = int(os.getenv("PREFETCH_QUEUE_SIZE", "32"))
+# Each product may cost a paid judge call, so requests are capped and every
+# product counts against RATE_LIMIT_PER_MINUTE.
+PREFETCH_MAX_PRODUCTS = int(os.getenv("PREFETCH_MAX_PRODUCTS", "10"))
+_prefetch_lock = threading.Lock()
+_prefetch_pending: set = set()
+_prefetch_executor: Optional[ThreadPoolExecutor] = None
+_prefetch_pid = 0
+
+
+def prefetch_executor() -> ThreadPoolExecutor:
+    # Created lazily per process so a preloaded gunicorn master never owns threads.
+    global _prefetch_executor, _prefetch_pid
+    if _prefetch_executor is None or _prefetch_pid != os.getpid():
+        _prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_CONCURRENCY, thread_name_prefix="prefetch")
+        _prefetch_pid = os.getpid()
+    return _prefetch_executor
+
+
+def run_prefetch(key: str, product_name: str, product_link: str, request_model: str) -> None:
+    try:
+        if OPENAI_API_KEY:
+            try:
+                judge_product(product_name, product_link, request_model, "/prefetch")
+            except JudgeError as je:
+                logger.info("Prefetch judge failed for %s: %s", product_link or product_name, je.message)
+        if product_link.lower().startswith(("http://", "https://")):
+            details = page_details(product_link)
+            if details["image"]:
+                warm_image_cache(details["image"], referer=product_link)
+    except Exception as e:
+        logger.exception("Prefetch failed for %s: %s", product_link or product_name, e)
+    finally:
+        with _prefetch_lock:
+            _prefetch_pending.discard(key)
+
+
+def enqueue_prefetch(product_name: str, product_link: str, request_model: str) -> str:
+    key = judge_cache_key(request_model, product_name, product_link)
+    with _prefetch_lock:
+        if key in _prefetch_pending:
+            return "duplicate"
+        if len(_prefetch_pending) >= PREFETCH_QUEUE_SIZE:
+            return "rejected"
+        _prefetch_pending.add(key)
+        executor = prefetch_executor()
+    executor.submit(run_prefetch, key, product_name, product_link, request_model)
+    return "queued"
+
+
 @app.route("/health", methods=["GET"])
 def health() -> Tuple[str, int]:
     return jsonify({"ok": True}), 200
 
 
+@app.route("/metrics/tokens", methods=["GET"])
+def token_metrics() -> Tuple[str, int]:
+    snapshot = token_counters.snapshot()
+    for totals in snapshot.values():
+        for field in ("calls", "input_tokens", "cached_tokens", "output_tokens"):
+            totals.setdefault(field, 0)
+        calls = totals["calls"] or 1
+        totals["avg_input_tokens"] = round(totals["input_tokens"] / calls, 1)
+        totals["avg_output_tokens"] = round(totals["output_tokens"] / calls, 1)
+        totals["cached_ratio"] = round(totals["cached_tokens"] / totals["input_tokens"], 3) if totals["input_tokens"] else 0.0
+    return jsonify({"prompt_version": PROMPT_VERSION, "endpoints": snapshot}), 200
+
+
 @app.route("/search", methods=["POST"])
 def search() -> Tuple[str, int]:
+    if not rate_limiter.allow(client_rate_key("/search")):
+        return rate_limited_response()
     payload = request.get_json(silent=True) or {}
     if not OPENAI_API_KEY:
         logger.error("Missing OPENAI_API_KEY. Refusing to call OpenAI.")
@@ -462,57 +1101,13 @@ def search() -> Tuple[str, int]:
     # Always judge first if a product is provided
     impact_label: str = ""
     if (product_name or product_link):
-        judge_prompt = build_judge_prompt(product_name, product_link)
-
         request_model = str(payload.get("model", "")).strip() or OPENAI_MODEL
-
-        def call_openai(selected_model: str):
-            return client.responses.create(
-                model=selected_model,
-                input=judge_prompt,
-            )
-
         try:
-            judge_resp = call_openai(request_model)
-        except OpenAIError as oe:
-            message_text = str(oe)
-            logger.warning("OpenAI judge error with model %s: %s", request_model, message_text)
-            is_rate_limited = ("429" in message_text) or ("rate limit" in message_text.lower())
-            if is_rate_limited and request_model != "gpt-5":
-                logger.info("Judge retry with fallback model gpt-5 after backoff...")
-                time.sleep(1.5)
-                try:
-                    judge_resp = call_openai("gpt-5")
-                except Exception as e2:
-                    logger.exception("Judge fallback failed: %s", e2)
-                    return jsonify({"error": "openai_api_error", "message": str(e2)}), 502
-            else:
-                return jsonify({"error": "openai_api_error", "message": message_text}), 502
-        except Exception as e:
-            logger.exception("Unexpected error calling OpenAI for judge: %s", e)
-            return jsonify({"error": "server_error", "message": str(e)}), 500
-
-        try:
-            raw_dump_j = judge_resp.model_dump_json(indent=2)  # type: ignore[attr-defined]
-            print("=== OpenAI raw judge response (model_dump_json) ===")
-            print(raw_dump_j)
-        except Exception:
-            print("=== OpenAI judge response (repr) ===")
-            print(repr(judge_resp))
-
-        judge_text = getattr(judge_resp, "output_text", None)
-        if judge_text is None:
-            try:
-                judge_text = judge_resp.output[0].content[0].text  # type: ignore[attr-defined]
-            except Exception:
-                judge_text = ""
-        print("=== OpenAI judge output_text ===")
-        print(judge_text)
-        impact_label = parse_impact_label(judge_text or "")
-        ecoscore_val = parse_ecoscore_from_text(judge_text or "")
-        # If the model didn't return a numeric ecoscore, fall back to label mapping only
-        if ecoscore_val <= 0.0:
-            ecoscore_val = ecoscore_from_impact(impact_label)
+            judged = judge_product(product_name, product_link, request_model, "/search:judge")
+        except JudgeError as je:
+            return jsonify({"error": je.error, "message": je.message}), je.status
+        impact_label = judged.impact
+        ecoscore_val = judged.ecoscore
 
         # Early return if ecoscore is good enough
         if ecoscore_val >= 3.0:
@@ -524,11 +1119,13 @@ def search() -> Tuple[str, int]:
             }
             return jsonify(result), 200
 
-    # Build alternatives prompt if we have a product, else generic topic prompt
+    # Build alternatives prompt if we have a product, else generic topic prompt.
+    # A few spare candidates are requested to refill slots freed by de-duplication.
+    candidate_count = max_results + SEARCH_CANDIDATE_EXTRA if max_results > 0 else max_results
     if product_name or product_link:
-        prompt = build_alternatives_prompt(product_name, product_link, max_results)
+        prompt = build_alternatives_prompt(product_name, product_link, candidate_count)
     else:
-        prompt = build_prompt(user_query, max_results)
+        prompt = build_prompt(user_query, candidate_count)
 
     logger.info("Incoming /search request")
     logger.debug("Request payload: %s", json.dumps(payload, indent=2))
@@ -542,6 +1139,7 @@ def search() -> Tuple[str, int]:
             model=selected_model,
             tools=[{"type": "web_search"}],
             input=prompt,
+            **structured_output_kwargs("search_results", RESULTS_SCHEMA),
         )
 
     try:
@@ -573,6 +1171,7 @@ def search() -> Tuple[str, int]:
         print("=== OpenAI response (repr) ===")
         print(repr(response))
 
+    record_token_usage("/search", response)
     output_text = getattr(response, "output_text", None)
     if output_text is None:
         try:
@@ -585,41 +1184,37 @@ def search() -> Tuple[str, int]:
 
     items = extract_items_from_text(output_text or "")
 
-    # If searching for alternatives to a specific product, constrain to Amazon domains and limit to requested max_results
+    # If searching for alternatives to a specific product, constrain to Amazon domains
     if product_name or product_link:
-        items = [it for it in items if is_amazon_url(it.get("url", ""))]
-        if max_results > 0:
-            items = items[:max_results]
+        items = [it for it in items if is_amazon_url(it.url)]
+
+    # Collapse the same product across marketplaces/listings before any enrichment
+    # work, preferring the caller's marketplace, then limit to requested max_results
+    preferred_suffix = compute_top_level_domain(product_link) if is_amazon_url(product_link) else ""
+    items = collapse_duplicates(items, preferred_suffix)
+    if max_results > 0:
+        items = items[:max_results]
 
     for item in items:
-        item["tld"] = compute_top_level_domain(item.get("url", ""))
+        item.tld = compute_top_level_domain(item.url)
         # Enrich with preview image if possible
-        if item.get("url"):
-            preview = fetch_og_image(item["url"])
+        if item.url:
+            preview = fetch_og_image(item.url)
             if preview:
-                item["image"] = preview
+                item.image = preview
             # Improve price accuracy for Amazon links
-            if is_amazon_url(item.get("url", "")):
-                accurate = extract_amazon_price(item["url"]) or ""
+            if is_amazon_url(item.url):
+                accurate = extract_amazon_price(item.url) or ""
                 if accurate:
-                    item["price"] = accurate
+                    item.price = accurate
                 # Also try to inline as data URL to avoid client-side loading issues
-                try:
-                    headers = {
-                        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
-                    }
-                    r = requests.get(preview, headers=headers, timeout=8)
-                    if r.ok and r.content:
-                        ctype = r.headers.get("Content-Type", "image/jpeg")
-                        import base64
-                        b64 = base64.b64encode(r.content).decode("ascii")
-                        item["image_data_url"] = f"data:{ctype};base64,{b64}"
-                except Exception as _e:
-                    logger.debug("Failed building data URL for %s: %s", preview, _e)
-
-    logger.debug("Extracted items: %s", json.dumps(items, indent=2))
-
-    result: Dict[str, Any] = {"results": items}
+                if preview:
+                    item.image_data_url = InlineImage(preview)
+
+    results = [item.to_dict() for item in items]
+    logger.debug("Extracted items: %s", json.dumps(results, indent=2, default=lambda o: getattr(o, "url", str(o))))
+
+    result: Dict[str, Any] = {"results": results}
     if user_query:
         result["query"] = user_query
     if product_name or product_link:
@@ -629,11 +1224,45 @@ def search() -> Tuple[str, int]:
     # Include ecoscore if we computed it in the judge step
     if 'ecoscore_val' in locals():
         result["ecoscore"] = ecoscore_val
-    return jsonify(result), 200
+    return stream_json_response(result), 200
+
+
+@app.route("/prefetch", methods=["POST"])
+def prefetch() -> Tuple[str, int]:
+    payload = request.get_json(silent=True) or {}
+    products = payload.get("products")
+    if not isinstance(products, list):
+        products = [payload.get("product")] if isinstance(payload.get("product"), dict) else []
+    if len(products) > PREFETCH_MAX_PRODUCTS:
+        return jsonify({
+            "error": "bad_request",
+            "message": f"At most {PREFETCH_MAX_PRODUCTS} products per request"
+        }), 400
+    request_model = str(payload.get("model", "")).strip() or OPENAI_MODEL
+
+    counts = {"queued": 0, "duplicate": 0, "rejected": 0, "invalid": 0}
+    valid: List[Tuple[str, str]] = []
+    for product in products:
+        if not isinstance(product, dict):
+            counts["invalid"] += 1
+            continue
+        product_name = str(product.get("name", "")).strip()
+        product_link = str(product.get("link", product.get("url", ""))).strip()
+        if not (product_name or product_link):
+            counts["invalid"] += 1
+            continue
+        valid.append((product_name, product_link))
+    if not rate_limiter.allow(client_rate_key("/prefetch"), cost=max(len(valid), 1)):
+        return rate_limited_response()
+    for product_name, product_link in valid:
+        counts[enqueue_prefetch(product_name, product_link, request_model)] += 1
+    return jsonify(counts), 202
 
 
 @app.route("/judge", methods=["POST"])
 def judge() -> Tuple[str, int]:
+    if not rate_limiter.allow(client_rate_key("/judge")):
+        return rate_limited_response()
     payload = request.get_json(silent=True) or {}
     if not OPENAI_API_KEY:
         logger.error("Missing OPENAI_API_KEY. Refusing to call OpenAI.")
@@ -649,64 +1278,16 @@ def judge() -> Tuple[str, int]:
     if not (product_name or product_link):
         return jsonify({"error": "bad_request", "message": "Provide product.name and/or product.link"}), 400
 
-    prompt = build_judge_prompt(product_name, product_link)
-
     request_model = str(payload.get("model", "")).strip() or OPENAI_MODEL
-
-    def call_openai(selected_model: str):
-        return client.responses.create(
-            model=selected_model,
-            input=prompt,
-        )
-
     try:
-        response = call_openai(request_model)
-    except OpenAIError as oe:
-        message_text = str(oe)
-        logger.warning("OpenAI judge error with model %s: %s", request_model, message_text)
-        is_rate_limited = ("429" in message_text) or ("rate limit" in message_text.lower())
-        if is_rate_limited and request_model != "gpt-5":
-            logger.info("Judge retry with fallback model gpt-5 after backoff...")
-            time.sleep(1.5)
-            try:
-                response = call_openai("gpt-5")
-            except Exception as e2:
-                logger.exception("Judge fallback failed: %s", e2)
-                return jsonify({"error": "openai_api_error", "message": str(e2)}), 502
-        else:
-            return jsonify({"error": "openai_api_error", "message": message_text}), 502
-    except Exception as e:
-        logger.exception("Unexpected error calling OpenAI for judge: %s", e)
-        return jsonify({"error": "server_error", "message": str(e)}), 500
-
-    try:
-        raw_dump = response.model_dump_json(indent=2)  # type: ignore[attr-defined]
-        print("=== OpenAI raw judge response (model_dump_json) ===")
-        print(raw_dump)
-    except Exception:
-        print("=== OpenAI judge response (repr) ===")
-        print(repr(response))
-
-    output_text = getattr(response, "output_text", None)
-    if output_text is None:
-        try:
-            output_text = response.output[0].content[0].text  # type: ignore[attr-defined]
-        except Exception:
-            output_text = ""
-
-    print("=== OpenAI judge output_text ===")
-    print(output_text)
-
-    impact = parse_impact_label(output_text or "")
-
-    ecoscore_val = parse_ecoscore_from_text(output_text or "")
-    if ecoscore_val <= 0.0:
-        ecoscore_val = ecoscore_from_impact(impact)
+        judged = judge_product(product_name, product_link, request_model, "/judge")
+    except JudgeError as je:
+        return jsonify({"error": je.error, "message": je.message}), je.status
 
     return jsonify({
         "product": {"name": product_name, "link": product_link},
-        "impact": impact,
-        "ecoscore": ecoscore_val
+        "impact": judged.impact,
+        "ecoscore": judged.ecoscore
     }), 200
 
 
@@ -0,0 +1,113 @@
+import argparse
+import base64
+import logging
+import os
+import sys
+import tempfile
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict
+
+# Isolate the benchmark from the real shared state; cache settings stay at the shipped defaults.
+os.environ.setdefault("ECOCART_STATE_DB", os.path.join(tempfile.mkdtemp(), "bench_state.sqlite3"))
+# No OpenAI calls are made, but the client refuses to construct without a key.
+os.environ.setdefault("OPENAI_API_KEY", "unused-by-benchmark")
+
+import requests
+
+import app
+
+
+def make_handler(image: bytes, send_length: bool) -> Any:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.startswith("/image"):
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                if send_length:
+                    self.send_header("Content-Length", str(len(image)))
+                self.end_headers()
+                view = memoryview(image)
+                for start in range(0, len(image), 64 * 1024):
+                    self.wfile.write(view[start:start + 64 * 1024])
+                return
+            host = self.headers.get("Host")
+            page = f'<html><head><meta property="og:image" content="http://{host}/image.jpg"></head></html>'.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    return Handler
+
+
+# The pre-streaming /extract-image path, kept here only as the comparison baseline.
+def legacy_extract(page_url: str) -> bytes:
+    img_url = app.fetch_og_image(page_url)
+    result: Dict[str, Any] = {"image": img_url}
+    r = requests.get(img_url, timeout=8)
+    if r.ok and r.content:
+        ctype = r.headers.get("Content-Type", "image/jpeg")
+        b64 = base64.b64encode(r.content).decode("ascii")
+        result["image_data_url"] = f"data:{ctype};base64,{b64}"
+    with app.app.app_context():
+        return app.jsonify(result).get_data()
+
+
+def streamed_extract(page_url: str) -> int:
+    client = app.app.test_client()
+    resp = client.get("/extract-image", query_string={"url": page_url}, buffered=False)
+    total = 0
+    for chunk in resp.response:
+        total += len(chunk)
+    resp.close()
+    return total
+
+
+def measure(fn: Any, *args: Any) -> Any:
+    tracemalloc.start()
+    try:
+        out = fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return out, peak
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Peak memory of image inlining, legacy vs streamed")
+    parser.add_argument("--size-kb", type=int, default=1500, help="Size of the served image in KiB")
+    parser.add_argument("--no-content-length", action="store_true", help="Serve the image without Content-Length")
+    args = parser.parse_args()
+
+    logging.getLogger("env-friendly-search").setLevel(logging.WARNING)
+    image = os.urandom(args.size_kb * 1024)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(image, not args.no_content_length))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    page_url = f"http://127.0.0.1:{server.server_address[1]}/product"
+
+    try:
+        legacy_body, legacy_peak = measure(legacy_extract, page_url)
+        streamed_len, streamed_peak = measure(streamed_extract, page_url)
+    finally:
+        server.shutdown()
+
+    print(f"Image: {len(image)} bytes, Content-Length sent: {not args.no_content_length}, cap: {app.IMAGE_INLINE_MAX_BYTES}")
+    print(f"legacy   peak {legacy_peak / 1024:10.1f} KiB  body {len(legacy_body)} bytes")
+    print(f"streamed peak {streamed_peak / 1024:10.1f} KiB  body {streamed_len} bytes")
+    if len(image) > app.IMAGE_INLINE_MAX_BYTES:
+        print("(image is over the inline cap, so the streamed response omits image_data_url)")
+    # jsonify appends a trailing newline that the streamed body does not.
+    if streamed_len > 100 and streamed_len != len(legacy_body.rstrip(b"\n")):
+        print("WARNING: streamed body length differs from legacy body")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import timeit
+from typing import Any, Dict, List
+
+import app
+
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_corpus", "model_outputs.jsonl")
+
+
+def load_corpus(path: str) -> List[Dict[str, str]]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# Pre-change parsers, kept here only as the comparison baseline.
+def legacy_extract_items(text: str) -> List[Dict[str, str]]:
+    try:
+        data = json.loads(text)
+        raw = data["results"] if isinstance(data, dict) and isinstance(data.get("results"), list) else data
+        if isinstance(raw, list):
+            items = []
+            for item in raw:
+                if not isinstance(item, dict):
+                    continue
+                name = str(item.get("name", "")).strip()
+                url = str(item.get("url", "")).strip()
+                price_val = item.get("price")
+                price = str(price_val).strip() if price_val is not None else ""
+                if not url:
+                    continue
+                entry = {"name": name or app.normalize_name_from_url(url), "url": url}
+                if price:
+                    entry["price"] = price
+                items.append(entry)
+            if items:
+                return items
+    except Exception:
+        pass
+    url_pattern = re.compile(r"https?://[^\s\)\]]+")
+    seen: Dict[str, None] = {}
+    for u in url_pattern.findall(text or ""):
+        seen.setdefault(u, None)
+    return [{"name": app.normalize_name_from_url(u), "url": u} for u in seen]
+
+
+def legacy_impact(text: str) -> str:
+    if not text:
+        return "Medium"
+    lowered = text.lower()
+    if "low" in lowered:
+        return "Low"
+    if "high" in lowered:
+        return "High"
+    if "medium" in lowered:
+        return "Medium"
+    tokens = [t.strip().lower() for t in re.split(r"[^a-zA-Z]+", lowered) if t.strip()]
+    for t in tokens:
+        if t in ("low", "medium", "high"):
+            return t.capitalize()
+    return "Medium"
+
+
+def legacy_ecoscore(text: str) -> float:
+    try:
+        if not text:
+            return 0.0
+        lowered = text.lower()
+        near_score = re.search(r"ecoscore\D*([1-5](?:\.\d+)?)", lowered)
+        if near_score:
+            val = float(near_score.group(1))
+            if 1.0 <= val <= 5.0:
+                return val
+        for match in re.finditer(r"\b([1-5](?:\.\d+)?)\b", lowered):
+            try:
+                val = float(match.group(1))
+                if 1.0 <= val <= 5.0:
+                    return val
+            except Exception:
+                continue
+    except Exception:
+        pass
+    return 0.0
+
+
+def legacy_judge(text: str) -> Any:
+    impact = legacy_impact(text or "")
+    score = legacy_ecoscore(text or "")
+    if score <= 0.0:
+        score = app.ecoscore_from_impact(impact)
+    return impact, score
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Micro-benchmark for model output parsing")
+    parser.add_argument("--corpus", default=CORPUS_PATH, help="JSONL file of recorded model outputs")
+    parser.add_argument("--number", type=int, default=20000, help="Passes over the corpus per timing run")
+    args = parser.parse_args()
+
+    # The parsers log at DEBUG on fallback paths; keep that out of the timings.
+    logging.getLogger("env-friendly-search").setLevel(logging.WARNING)
+
+    corpus = load_corpus(args.corpus)
+    search_texts = [r["text"] for r in corpus if r.get("kind") == "search"]
+    judge_texts = [r["text"] for r in corpus if r.get("kind") == "judge"]
+    print(f"Corpus: {len(search_texts)} search outputs, {len(judge_texts)} judge outputs")
+
+    # Plain-text judge outputs must score exactly as the original parser did.
+    mismatches = [
+        t for t in judge_texts
+        if not t.lstrip().startswith("{")
+        and legacy_judge(t) != (app.parse_judge_output(t).impact, app.parse_judge_output(t).ecoscore)
+    ]
+    for t in mismatches:
+        print(f"MISMATCH vs legacy judge parser: {t!r}")
+
+    cases = [
+        ("search legacy", lambda: [legacy_extract_items(t) for t in search_texts]),
+        ("search current", lambda: [app.extract_items_from_text(t) for t in search_texts]),
+        ("judge legacy", lambda: [legacy_judge(t) for t in judge_texts]),
+        ("judge current", lambda: [app.parse_judge_output(t) for t in judge_texts]),
+    ]
+    for label, fn in cases:
+        best = min(timeit.repeat(fn, number=args.number, repeat=3))
+        per_pass_us = best / args.number * 1e6
+        print(f"{label:<16} {per_pass_us:8.2f} us/corpus pass")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
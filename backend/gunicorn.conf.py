@@ -0,0 +1,25 @@
+import multiprocessing
+import os
+
+
+# Production serving profile: gunicorn -c gunicorn.conf.py wsgi:application
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '5057')}"
+workers = int(os.getenv("WEB_WORKERS", str(multiprocessing.cpu_count() * 2 + 1)))
+threads = int(os.getenv("WEB_THREADS", "4"))
+worker_class = "gthread"
+preload_app = os.getenv("WEB_PRELOAD", "1") != "0"
+# /search chains a judge call, a web_search call and page fetches per result.
+timeout = int(os.getenv("WEB_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+max_requests = int(os.getenv("WEB_MAX_REQUESTS", "1000"))
+max_requests_jitter = max_requests // 10
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
+
+
+def post_fork(server, worker):
+    from app import reset_after_fork
+
+    reset_after_fork()
@@ -0,0 +1,268 @@
+import cProfile
+import glob
+import hmac
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from typing import Any, Dict, List
+
+from flask import Flask, Response, g, jsonify, request
+
+
+logger = logging.getLogger("env-friendly-search")
+
+# Opt-in per-request profiling. A request is profiled when it carries
+# "X-Profile: <ADMIN_TOKEN>" or is picked by PROFILE_SAMPLE_RATE (0.0-1.0).
+# Results go to PROFILE_DIR, which keeps only the newest PROFILE_KEEP profiles.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "ecocart_profiles"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "25"))
+
+# cProfile and tracemalloc are process-wide, so only one request per process is
+# profiled at a time; others that would have been sampled simply run unprofiled.
+_profile_lock = threading.Lock()
+
+# tracemalloc sees every thread, so allocations from other requests in flight
+# (gthread workers) land in the profile too; the summary records how many there were.
+_inflight_lock = threading.Lock()
+_inflight = 0
+_active_state: Dict[str, Any] = {}
+
+
+def admin_authorized() -> bool:
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get("Authorization", "").encode("utf-8"), f"Bearer {ADMIN_TOKEN}".encode("utf-8"))
+
+
+def should_profile() -> bool:
+    header = request.headers.get("X-Profile", "")
+    if header and ADMIN_TOKEN and hmac.compare_digest(header.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def track_request_start() -> None:
+    global _inflight
+    with _inflight_lock:
+        _inflight += 1
+        if _active_state:
+            _active_state["max_concurrent"] = max(_active_state["max_concurrent"], _inflight)
+
+
+def track_request_end(exc: Any = None) -> None:
+    global _inflight
+    with _inflight_lock:
+        _inflight -= 1
+
+
+def start_profile() -> None:
+    if request.method == "OPTIONS" or request.path.startswith("/admin/"):
+        return
+    if not should_profile() or not _profile_lock.acquire(blocking=False):
+        return
+    try:
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        g.profile_state = {
+            "path": request.path,
+            "method": request.method,
+            "profiler": profiler,
+            "wall_start": time.perf_counter(),
+            "cpu_start": time.thread_time(),
+        }
+        with _inflight_lock:
+            g.profile_state["max_concurrent"] = _inflight
+            _active_state.update(g.profile_state)
+        profiler.enable()
+    except Exception as e:
+        # e.g. another profiler already active in this interpreter
+        logger.warning("Could not start request profile: %s", e)
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        g.pop("profile_state", None)
+        with _inflight_lock:
+            _active_state.clear()
+        _profile_lock.release()
+
+
+def defer_profile_for_stream(response: Response) -> Response:
+    # Streamed bodies (e.g. inlined images) are produced after teardown_request,
+    # so the profile is closed when the response itself is closed instead.
+    if response.is_streamed and "profile_state" in g:
+        state = g.pop("profile_state")
+        response.call_on_close(lambda: close_profile(state, None))
+    return response
+
+
+def finish_profile(exc: Any = None) -> None:
+    state = g.pop("profile_state", None)
+    if state is not None:
+        close_profile(state, exc)
+
+
+def close_profile(state: Dict[str, Any], exc: Any) -> None:
+    try:
+        state["profiler"].disable()
+        wall = time.perf_counter() - state["wall_start"]
+        cpu = time.thread_time() - state["cpu_start"]
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        with _inflight_lock:
+            concurrent = _active_state.get("max_concurrent", 1)
+            _active_state.clear()
+        write_profile(state["path"], state["method"], state["profiler"], snapshot, wall, cpu, peak, concurrent, exc)
+    except Exception as e:
+        logger.warning("Could not write request profile: %s", e)
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        with _inflight_lock:
+            _active_state.clear()
+        _profile_lock.release()
+
+
+def summarize_stats(profiler: cProfile.Profile) -> List[Dict[str, Any]]:
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    rows = []
+    for (filename, lineno, func), (_, ncalls, tottime, cumtime, _) in stats.stats.items():  # type: ignore[attr-defined]
+        rows.append({
+            "function": f"{os.path.basename(filename)}:{lineno}({func})",
+            "calls": ncalls,
+            "tottime": round(tottime, 6),
+            "cumtime": round(cumtime, 6),
+        })
+    rows.sort(key=lambda r: r["tottime"], reverse=True)
+    return rows[:PROFILE_TOP_N]
+
+
+def summarize_allocations(snapshot: tracemalloc.Snapshot) -> List[Dict[str, Any]]:
+    rows = []
+    for stat in snapshot.statistics("lineno")[:PROFILE_TOP_N]:
+        frame = stat.traceback[0]
+        rows.append({
+            "location": f"{os.path.basename(frame.filename)}:{frame.lineno}",
+            "size_bytes": stat.size,
+            "count": stat.count,
+        })
+    return rows
+
+
+def write_profile(path: str, method: str, profiler: cProfile.Profile, snapshot: tracemalloc.Snapshot, wall: float, cpu: float, peak: int, concurrent: int, exc: Any) -> None:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+    slug = path.strip("/").replace("/", "_") or "root"
+    base = os.path.join(PROFILE_DIR, f"{stamp}-{os.getpid()}-{uuid.uuid4().hex[:12]}-{slug}")
+    profiler.dump_stats(f"{base}.prof")
+    summary = {
+        "id": os.path.basename(base),
+        "path": path,
+        "method": method,
+        "created_at": time.time(),
+        "wall_seconds": round(wall, 4),
+        # thread CPU vs wall clock: the difference is time spent waiting on I/O
+        "cpu_seconds": round(cpu, 4),
+        "wait_seconds": round(max(wall - cpu, 0.0), 4),
+        # process-wide: includes allocations of any concurrent requests
+        "peak_traced_bytes": peak,
+        "max_concurrent_requests": concurrent,
+        "error": repr(exc) if exc else "",
+        "top_functions": summarize_stats(profiler),
+        "top_allocations": summarize_allocations(snapshot),
+    }
+    with open(f"{base}.json", "w", encoding="utf-8") as f:
+        json.dump(summary, f)
+    rotate_profiles()
+    logger.info(
+        "Profiled %s %s wall=%.3fs cpu=%.3fs peak=%dB -> %s.json",
+        method, path, wall, cpu, peak, base,
+    )
+
+
+def rotate_profiles() -> None:
+    summaries = sorted(glob.glob(os.path.join(PROFILE_DIR, "*.json")), key=os.path.getmtime, reverse=True)
+    for path in summaries[PROFILE_KEEP:]:
+        for stale in (path, path[:-len(".json")] + ".prof"):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+
+
+def load_summaries() -> List[Dict[str, Any]]:
+    summaries = []
+    for path in sorted(glob.glob(os.path.join(PROFILE_DIR, "*.json")), key=os.path.getmtime, reverse=True):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                summaries.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return summaries
+
+
+def profiles_index() -> Any:
+    if not admin_authorized():
+        return jsonify({"error": "forbidden", "message": "admin token required"}), 403
+    summaries = load_summaries()
+    # Aggregate self time and allocations across all kept profiles to surface hot spots.
+    hot_functions: Dict[str, float] = {}
+    hot_allocations: Dict[str, int] = {}
+    for summary in summaries:
+        for row in summary.get("top_functions", []):
+            hot_functions[row["function"]] = hot_functions.get(row["function"], 0.0) + row["tottime"]
+        for row in summary.get("top_allocations", []):
+            hot_allocations[row["location"]] = hot_allocations.get(row["location"], 0) + row["size_bytes"]
+    return jsonify({
+        "directory": PROFILE_DIR,
+        "count": len(summaries),
+        "hot_functions": [
+            {"function": k, "tottime": round(v, 6)}
+            for k, v in sorted(hot_functions.items(), key=lambda kv: kv[1], reverse=True)[:PROFILE_TOP_N]
+        ],
+        "hot_allocations": [
+            {"location": k, "size_bytes": v}
+            for k, v in sorted(hot_allocations.items(), key=lambda kv: kv[1], reverse=True)[:PROFILE_TOP_N]
+        ],
+        "profiles": [
+            {key: s.get(key) for key in ("id", "path", "method", "created_at", "wall_seconds", "cpu_seconds", "wait_seconds", "peak_traced_bytes", "max_concurrent_requests", "error")}
+            for s in summaries
+        ],
+    }), 200
+
+
+def profile_detail(profile_id: str) -> Any:
+    if not admin_authorized():
+        return jsonify({"error": "forbidden", "message": "admin token required"}), 403
+    name = os.path.basename(profile_id)
+    if request.args.get("format") == "pstats":
+        path = os.path.join(PROFILE_DIR, f"{name}.prof")
+        if not os.path.isfile(path):
+            return jsonify({"error": "not_found"}), 404
+        with open(path, "rb") as f:
+            return Response(f.read(), content_type="application/octet-stream"), 200
+    path = os.path.join(PROFILE_DIR, f"{name}.json")
+    if not os.path.isfile(path):
+        return jsonify({"error": "not_found"}), 404
+    with open(path, "r", encoding="utf-8") as f:
+        return jsonify(json.load(f)), 200
+
+
+def register_profiling(app: Flask) -> None:
+    app.before_request(track_request_start)
+    app.before_request(start_profile)
+    app.after_request(defer_profile_for_stream)
+    app.teardown_request(finish_profile)
+    app.teardown_request(track_request_end)
+    app.add_url_rule("/admin/profiles", "profiles_index", profiles_index, methods=["GET"])
+    app.add_url_rule("/admin/profiles/<profile_id>", "profile_detail", profile_detail, methods=["GET"])
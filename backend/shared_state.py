@@ -0,0 +1,243 @@
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+logger = logging.getLogger("env-friendly-search")
+
+# Every worker process opens the same SQLite file, so caches and rate limit
+# counters are shared across a multi-worker server on one box.
+STATE_DB_PATH = os.getenv("ECOCART_STATE_DB", os.path.join(tempfile.gettempdir(), "ecocart_state.sqlite3"))
+
+
+class SharedStateStore:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized_pid = 0
+
+    def connection(self) -> sqlite3.Connection:
+        # Connections must never cross a fork, so they are keyed by pid as well as thread.
+        pid = os.getpid()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and getattr(self._local, "pid", 0) == pid:
+            return conn
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._local.conn = conn
+        self._local.pid = pid
+        self._ensure_schema(conn, pid)
+        return conn
+
+    def _ensure_schema(self, conn: sqlite3.Connection, pid: int) -> None:
+        with self._init_lock:
+            if self._initialized_pid == pid:
+                return
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters ("
+                " key TEXT NOT NULL, window_start INTEGER NOT NULL, count INTEGER NOT NULL,"
+                " PRIMARY KEY (key, window_start))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS totals ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, field TEXT NOT NULL, value INTEGER NOT NULL,"
+                " PRIMARY KEY (namespace, key, field))"
+            )
+            self._initialized_pid = pid
+
+    def purge_expired(self) -> None:
+        now = time.time()
+        conn = self.connection()
+        conn.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+        conn.execute("DELETE FROM counters WHERE window_start < ?", (int(now) - 86400,))
+
+
+class SharedCache:
+    # max_entries / max_bytes (0 = unlimited) bound the namespace; expired rows and
+    # anything over the limits are trimmed every trim_every writes from this process.
+    def __init__(
+        self,
+        store: SharedStateStore,
+        namespace: str,
+        ttl_seconds: float,
+        max_entries: int = 0,
+        max_bytes: int = 0,
+        trim_every: int = 100,
+    ) -> None:
+        self.store = store
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.trim_every = max(trim_every, 1)
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        if self.ttl_seconds <= 0:
+            return None
+        try:
+            row = self.store.connection().execute(
+                "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?",
+                (self.namespace, key),
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Shared cache read failed namespace=%s: %s", self.namespace, e)
+            return None
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0])
+
+    def contains(self, key: str) -> bool:
+        if self.ttl_seconds <= 0:
+            return False
+        try:
+            row = self.store.connection().execute(
+                "SELECT 1 FROM cache WHERE namespace = ? AND key = ? AND expires_at >= ?",
+                (self.namespace, key, time.time()),
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Shared cache read failed namespace=%s: %s", self.namespace, e)
+            return False
+        return row is not None
+
+    def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None) -> None:
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        if ttl <= 0:
+            return
+        encoded = json.dumps(value, separators=(",", ":"))
+        if self.max_bytes and len(encoded) > self.max_bytes:
+            return
+        try:
+            self.store.connection().execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (self.namespace, key, encoded, time.time() + ttl),
+            )
+        except sqlite3.Error as e:
+            logger.warning("Shared cache write failed namespace=%s: %s", self.namespace, e)
+            return
+        with self._writes_lock:
+            self._writes += 1
+            due = self._writes % self.trim_every == 0
+        if due:
+            self.trim()
+
+    def trim(self) -> None:
+        try:
+            conn = self.store.connection()
+            conn.execute("DELETE FROM cache WHERE namespace = ? AND expires_at < ?", (self.namespace, time.time()))
+            if not (self.max_entries or self.max_bytes):
+                return
+            # Newest entries (latest expiry) are kept first.
+            rows = conn.execute(
+                "SELECT key, length(value) FROM cache WHERE namespace = ? ORDER BY expires_at DESC",
+                (self.namespace,),
+            ).fetchall()
+            kept_bytes = 0
+            stale = []
+            for idx, (key, size) in enumerate(rows):
+                kept_bytes += size
+                if (self.max_entries and idx >= self.max_entries) or (self.max_bytes and kept_bytes > self.max_bytes):
+                    stale.append((self.namespace, key))
+            if stale:
+                conn.executemany("DELETE FROM cache WHERE namespace = ? AND key = ?", stale)
+                logger.info("Trimmed %d entries from shared cache namespace=%s", len(stale), self.namespace)
+        except sqlite3.Error as e:
+            logger.warning("Shared cache trim failed namespace=%s: %s", self.namespace, e)
+
+    def delete(self, key: str) -> None:
+        try:
+            self.store.connection().execute(
+                "DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key)
+            )
+        except sqlite3.Error as e:
+            logger.warning("Shared cache delete failed namespace=%s: %s", self.namespace, e)
+
+
+# Fixed-window request counter; a limit of 0 disables limiting. cost lets one
+# request count as several units (e.g. one per prefetched product). Rows for past
+# windows are deleted every prune_every calls from this process.
+class RateLimiter:
+    def __init__(self, store: SharedStateStore, limit: int, window_seconds: int = 60, prune_every: int = 500) -> None:
+        self.store = store
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.prune_every = max(prune_every, 1)
+        self._calls = 0
+        self._calls_lock = threading.Lock()
+
+    def allow(self, key: str, cost: int = 1) -> bool:
+        if self.limit <= 0:
+            return True
+        window_start = int(time.time()) // self.window_seconds * self.window_seconds
+        with self._calls_lock:
+            self._calls += 1
+            due = self._calls % self.prune_every == 0
+        if due:
+            self.prune(window_start)
+        try:
+            row = self.store.connection().execute(
+                "INSERT INTO counters (key, window_start, count) VALUES (?, ?, ?)"
+                " ON CONFLICT (key, window_start) DO UPDATE SET count = count + excluded.count"
+                " RETURNING count",
+                (key, window_start, cost),
+            ).fetchone()
+        except sqlite3.Error as e:
+            # Fail open: a locked or broken state file should not take the API down.
+            logger.warning("Rate limiter update failed for %s: %s", key, e)
+            return True
+        return row is None or row[0] <= self.limit
+
+    def prune(self, window_start: int) -> None:
+        try:
+            self.store.connection().execute("DELETE FROM counters WHERE window_start < ?", (window_start,))
+        except sqlite3.Error as e:
+            logger.warning("Rate limiter prune failed: %s", e)
+
+
+# Monotonic per-key totals (e.g. token usage per endpoint) summed across workers.
+class SharedCounters:
+    def __init__(self, store: SharedStateStore, namespace: str) -> None:
+        self.store = store
+        self.namespace = namespace
+
+    def add(self, key: str, values: Dict[str, int]) -> None:
+        try:
+            conn = self.store.connection()
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany(
+                    "INSERT INTO totals (namespace, key, field, value) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (namespace, key, field) DO UPDATE SET value = value + excluded.value",
+                    [(self.namespace, key, field, int(val)) for field, val in values.items()],
+                )
+        except sqlite3.Error as e:
+            logger.warning("Shared counter update failed namespace=%s key=%s: %s", self.namespace, key, e)
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        totals: Dict[str, Dict[str, int]] = {}
+        try:
+            rows = self.store.connection().execute(
+                "SELECT key, field, value FROM totals WHERE namespace = ?", (self.namespace,)
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning("Shared counter read failed namespace=%s: %s", self.namespace, e)
+            return totals
+        for key, field, value in rows:
+            totals.setdefault(key, {})[field] = value
+        return totals
+
+
+store = SharedStateStore(STATE_DB_PATH)
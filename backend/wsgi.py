@@ -0,0 +1,8 @@
+from app import app, warm_up
+
+
+# With gunicorn's preload_app this import (and the warm-up) happens once in the
+# master process before workers fork; without it, each worker warms itself.
+warm_up()
+
+application = app